@@ -1,26 +1,26 @@
 #!/usr/bin/env python3
 
-import contextlib
 import functools
 import re
 import itertools
 import argparse
 import os
-import io
-import copy
 import json
 from importlib import resources
-from collections import UserDict
-from typing import Optional, Sequence, Mapping, Any, IO
+from typing import Optional, Sequence, Mapping, Set, Tuple, IO
 
 # TODO is this actually safe?
 import mktcmenu_schemas
 import jsonschema
 import yaml
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+
+# The pure-Python loader/dumper are several times slower than the libyaml-backed
+# ones. Keep them as a fallback but make the user aware of it (see __main__).
+Loader = getattr(yaml, 'CLoader', None)
+Dumper = getattr(yaml, 'CDumper', None)
+HAS_LIBYAML = Loader is not None and Dumper is not None
+if not HAS_LIBYAML:
+    Loader, Dumper = yaml.SafeLoader, yaml.SafeDumper
 
 yaml_load = functools.partial(yaml.load, Loader=Loader)
 yaml_dump = functools.partial(yaml.dump, Dumper=Dumper, default_flow_style=False)
@@ -31,6 +31,15 @@ RE_CPP_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 DESC_SUFFIX = '.tcmdesc.yaml'
 MAP_SUFFIX = '.tcmmap.yaml'
 
+REQUIRE_LIBYAML_ENV = 'MKTCMENU_REQUIRE_LIBYAML'
+
+ARGS_EPILOG = f'''
+PyYAML should be built against libyaml for faster descriptor and mapping file
+parsing (e.g. install libyaml-dev, then reinstall PyYAML with
+`pip install --no-binary pyyaml --force-reinstall pyyaml`). Set
+{REQUIRE_LIBYAML_ENV}=1 to refuse running without it.
+'''.strip()
+
 SRC_HEADER = '''
 /**
  * Automatically managed by mktcmenu.
@@ -40,9 +49,29 @@ SRC_HEADER = '''
  */
 '''.lstrip()
 
+# Per-item code templates, formatted in one go by the menu item emitters
+STATIC_ITEM_SRC_TEMPLATE = '''
+static const {minfo_type} {minfo_name}{progmem} = {{ {minfo} }};
+{menu_type} {menu_name}({menu_item});
+
+'''.lstrip()
+
+DYNAMIC_ITEM_SRC_TEMPLATE = '''
+{menu_type} {menu_name}({menu_item});
+
+'''.lstrip()
+
+RENDER_CALLBACK_SRC_TEMPLATE = '''
+RENDERING_CALLBACK_NAME_INVOKE({callback_name}, {callback_parent}, {name}, {eeprom_offset}, {callback_ref})
+'''.lstrip()
+
+ITEM_HDR_TEMPLATE = '''
+extern {menu_type} {menu_name};
+'''.lstrip()
+
 
 def parse_args():
-    p = argparse.ArgumentParser()
+    p = argparse.ArgumentParser(epilog=ARGS_EPILOG)
     p.add_argument('desc', help='Menu descriptor file (*.tcmdesc.yaml).')
     p.add_argument('-e', '--eeprom-map', help='Override EEPROM mapping file location (defaults to <descriptor basename without suffix>.tcmmap.yaml).')
     p.add_argument('-c', '--eeprom-capacity', type=int, help='Set EEPROM capacity (only used during initialization/defragmentation of the mapping file).')
@@ -53,50 +82,83 @@ def parse_args():
     return p, p.parse_args()
 
 # C++ code emitter helpers
+# Declaration keyword prefixes indexed by (is_extern, is_static, is_const, is_constexpr)
+CPPDEF_KW_PREFIXES = {
+    (extern, static, const, constexpr): f'{"extern " if extern else ""}{"static " if static else ""}{"constexpr " if constexpr else ""}{"const " if const else ""}'
+    for extern, static, const, constexpr in itertools.product((False, True), repeat=4)
+}
+
 def emit_cppdef(buf, name, type_, is_static=False, is_const=False, is_constexpr=False, is_extern=False, nmemb=-1, init=False, extra_decl=tuple()):
-    extern_kw = 'extern ' if is_extern else ''
-    static_kw = 'static ' if is_static else ''
-    const_kw = 'const ' if is_const else ''
-    constexpr_kw = 'constexpr ' if is_constexpr else ''
-    extra_decl_str = f' {" ".join(extra_decl)}' if len(extra_decl) != 0 else ''
-    if nmemb < 0:
-        nmemb_str = ''
-    elif nmemb == 0:
-        nmemb_str = '[]'
-    else:
-        nmemb_str = f'[{nmemb}]'
-    buf.write(f'{extern_kw}{static_kw}{constexpr_kw}{const_kw}{type_} {name}{nmemb_str}{extra_decl_str}{" = " if init else ""}')
+    buf.write(CPPDEF_KW_PREFIXES[is_extern, is_static, is_const, is_constexpr])
+    buf.write(type_)
+    buf.write(' ')
+    buf.write(name)
+    if nmemb == 0:
+        buf.write('[]')
+    elif nmemb > 0:
+        buf.write(f'[{nmemb}]')
+    if len(extra_decl) != 0:
+        buf.write(' ')
+        buf.write(' '.join(extra_decl))
+    if init:
+        buf.write(' = ')
 
 def emit_cppeol(buf):
     buf.write(';\n')
 
-@contextlib.contextmanager
-def emit_cppobjarray(buf, multiline=False):
-    buf.write('{')
-    buf.write('\n' if multiline else ' ')
-    try:
-        yield buf
-    finally:
-        buf.write('\n' if multiline else ' ')
-        buf.write('}')
+def emit_cppobjarray_begin(buf, multiline=False):
+    buf.write('{\n' if multiline else '{ ')
+
+def emit_cppobjarray_end(buf, multiline=False):
+    buf.write('\n}' if multiline else ' }')
 
 def emit_cppindent(buf, level=1):
     buf.write('    ' * level)
 
+CPPSTR_ESCAPES = str.maketrans({'"': r'\"', '\\': r'\\'})
+
+# Names, units and options are looked up repeatedly and never change
+@functools.lru_cache(maxsize=None)
 def cppstr(str_):
-    str_escaped = str(str_).replace('"', r'\"')
+    str_escaped = str(str_).translate(CPPSTR_ESCAPES)
     return f'"{str_escaped}"'
 
 
-class EEPROMMap(UserDict):
+# Write-only string accumulator for the code emitters
+class StringBuffer:
+    __slots__ = ('_parts', 'write')
+
+    def __init__(self):
+        self._parts = []
+        self.write = self._parts.append
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+class EEPROMMap:
+    # Offsets and sizes are kept in two flat dicts keyed by variable ID
+    # instead of one {'offset': ..., 'size': ...} dict per variable.
+    __slots__ = ('_offset', '_size', '_auto_index', 'capacity', 'varstore_bar', 'spare_segments')
+
     def __init__(self, capacity=0xffff, reserve=0):
-        super().__init__()
-        super().__setitem__('_reserved', {'offset': 0, 'size': 2})
+        self._offset = {'_reserved': 0}
+        self._size = {'_reserved': 2}
         self._auto_index = 2
         self.capacity = capacity
         self.varstore_bar = self.capacity - reserve
         self.spare_segments = {}
 
+    def __delitem__(self, name):
+        del self._offset[name]
+        del self._size[name]
+
+    def get_offset(self, name, default=None):
+        return self._offset.get(name, default)
+
+    def get_size(self, name, default=None):
+        return self._size.get(name, default)
+
     @property
     def auto_index(self):
         return self._auto_index
@@ -108,10 +170,10 @@ class EEPROMMap(UserDict):
             raise RuntimeError('EEPROM address space exhausted. Please run defragmentation and bump EEPROM mapping version.')
         elif offset >= max_space or offset+size >= max_space:
             raise RuntimeError('No space left on EEPROM. Please run defragmentation and bump EEPROM mapping version.')
-        allocated = {'offset': offset, 'size': size}
-        super().__setitem__(name, allocated)
+        self._offset[name] = offset
+        self._size[name] = size
         self._auto_index += size
-        return allocated
+        return offset
 
     def check_consistency(self):
         pass # TODO perform intersection to find holes/overlaps/oob allocations
@@ -124,8 +186,8 @@ class EEPROMMap(UserDict):
         obj.varstore_bar = data['varstore-bar']
         obj._auto_index = data['auto-index']
         if 'vars' in data:
-            obj.data.clear()
-            obj.data.update(data['vars'])
+            obj._offset = {name: offsize['offset'] for name, offsize in data['vars'].items()}
+            obj._size = {name: offsize['size'] for name, offsize in data['vars'].items()}
         if 'spare-segments' in data:
             obj.spare_segments.update(data['spare-segments'])
         return obj
@@ -135,42 +197,53 @@ class EEPROMMap(UserDict):
             'capacity': self.capacity,
             'varstore-bar': self.varstore_bar,
             'auto-index': self._auto_index,
-            'vars': self.data,
+            'vars': {name: {'offset': offset, 'size': self._size[name]} for name, offset in self._offset.items()},
         }
         if len(self.spare_segments) != 0:
             data['spare-segments'] = self.spare_segments
         yaml_dump(data, fmap)
 
 # Data model for menu entries 
+def validate_entry(props, key, required=False, default=None, extra_validation=None):
+    if required:
+        if key not in props:
+            raise ValueError(f'Required property {key} is missing.')
+        value = props[key]
+    else:
+        value = props.get(key, default)
+    if extra_validation is not None:
+        extra_validation(value)
+    return value
+
+
 class MenuBaseType:
     auto_index = 1
     serializable = False
     cpp_type_prefix = ''
     render_callback_parent = ''
     def __init__(self, props, alias):
-        v = functools.partial(self._validate_entry, props)
         self._global_index = MenuBaseType.auto_index
         MenuBaseType.auto_index += 1
-        self.id_ = v('id')
-        self.id_suffix = v('id-suffix')
-        self.name = v('name', required=True)
-        self.persistent = v('persistent', default=False)
-        self.read_only = v('read-only', default=False)
-        self.local_only = v('local-only', default=False)
-        self.visible = v('visible', default=True)
-        self.callback = v('callback')
-
-    @staticmethod
-    def _validate_entry(props, key, required=False, default=None, extra_validation=None):
-        if required and key not in props:
-            raise ValueError(f'Required property {key} is missing.')
-        if required:
-            value = props[key]
+        self.id_ = validate_entry(props, 'id')
+        self.id_suffix = validate_entry(props, 'id-suffix')
+        self.name = validate_entry(props, 'name', required=True)
+        self.persistent = validate_entry(props, 'persistent', default=False)
+        self.read_only = validate_entry(props, 'read-only', default=False)
+        self.local_only = validate_entry(props, 'local-only', default=False)
+        self.visible = validate_entry(props, 'visible', default=True)
+        self.callback = validate_entry(props, 'callback')
+        # The ID only depends on properties that never change after parsing,
+        # so resolve it once here instead of on every generate_id() call.
+        if self.id_ is not None:
+            id_ = self.id_
         else:
-            value = props.get(key, default)
-        if extra_validation is not None:
-            extra_validation(value)
-        return value
+            id_ = ''.join(w.capitalize() for w in RE_AUTOID_DELIM.split(self.name))
+        #self._id = f'{id_}{self.get_type_name()}{self.id_suffix if self.id_suffix is not None else ""}'
+        self._id = f'{id_}{self.id_suffix if self.id_suffix is not None else ""}'
+        # C++ names that depend on the enclosing submenus. Filled by assign_namespace().
+        self._ns_id = None
+        self._menu_name = None
+        self._minfo_name = None
 
     def emit_code(self, ctx: 'CodeEmitterContext'):
         raise NotImplementedError()
@@ -181,10 +254,8 @@ class MenuBaseType:
     def get_type_name(self):
         raise NotImplementedError()
 
-    def emit_default_flags_block(self, buf, namespace: Sequence["MenuBaseType"]):
-        id_ = self.generate_id()
-        ns_id = ''.join(ns.generate_id() for ns in namespace)
-        menu_name = f'menu{ns_id}{id_}'
+    def emit_default_flags_block(self, buf):
+        menu_name = self.get_menu_name()
         emit_cppindent(buf, level=1)
         if self.read_only:
             buf.write(f'{menu_name}.setReadOnly(true);')
@@ -193,60 +264,44 @@ class MenuBaseType:
         if not self.visible:
             buf.write(f'{menu_name}.setVisible(false);')
 
-    def emit_simple_static_menu_item(self, ctx: 'CodeEmitterContext', minfo_extra: Sequence[Any], menu_item_extra: Sequence[Any], cpp_type_prefix: Optional[str] = None, cpp_type_prefix_minfo: Optional[str] = None, next_entry_namespace: Sequence["MenuBaseType"] = None):
-        eeprom_offset = self.find_or_allocate_eeprom_space(ctx.eeprom_map)
+    def emit_simple_static_menu_item(self, ctx: 'CodeEmitterContext', minfo_extra: Tuple[str, ...], menu_item_extra: Tuple[str, ...], cpp_type_prefix: Optional[str] = None, cpp_type_prefix_minfo: Optional[str] = None):
+        menu_name = self.get_menu_name()
+        minfo_name = self._minfo_name
 
-        id_ = self.generate_id()
-        ns_id = ''.join(ns.generate_id() for ns in ctx.namespace)
-        if next_entry_namespace is None:
-            next_ns_id = ns_id
-        else:
-            next_ns_id = ''.join(ns.generate_id() for ns in next_entry_namespace)
-
-        minfo_name = f'minfo{ns_id}{id_}'
-        menu_name = f'menu{ns_id}{id_}'
+        eeprom_offset = self.find_or_allocate_eeprom_space(ctx.eeprom_map)
 
         cpp_type_prefix = self.__class__.cpp_type_prefix if cpp_type_prefix is None else cpp_type_prefix
         cpp_type_prefix_minfo = cpp_type_prefix if cpp_type_prefix_minfo is None else cpp_type_prefix_minfo
         minfo_type = f'{cpp_type_prefix_minfo}MenuInfo'
         menu_type = f'{cpp_type_prefix}MenuItem'
 
-        next_name = f'menu{next_ns_id}{ctx.next_entry.generate_id()}' if ctx.next_entry is not None else None
-        next_name_ref = f'&{next_name}' if next_name is not None else 'nullptr'
+        next_name_ref = f'&{ctx.next_entry.get_menu_name()}' if ctx.next_entry is not None else 'nullptr'
 
-        minfo_builtin = (cppstr(self.name), self._global_index, hex(eeprom_offset),)
+        minfo_builtin = (cppstr(self.name), str(self._global_index), hex(eeprom_offset),)
         menu_item_first = (f'&{minfo_name}',)
         menu_item_last = (next_name_ref,)
 
-        emit_cppdef(ctx.bufsrc, minfo_name, minfo_type, is_const=True, is_static=True, extra_decl=('PROGMEM', ) if ctx.use_pgmspace else tuple(), init=True)
-        with emit_cppobjarray(ctx.bufsrc):
-            ctx.bufsrc.write(', '.join(map(str, itertools.chain(minfo_builtin, minfo_extra))))
-        emit_cppeol(ctx.bufsrc)
-
-        emit_cppdef(ctx.bufsrc, menu_name, menu_type)
-        ctx.bufsrc.write(f'({", ".join(map(str, itertools.chain(menu_item_first, menu_item_extra, menu_item_last)))})')
-        emit_cppeol(ctx.bufsrc)
-        ctx.bufsrc.write('\n')
-
-        emit_cppdef(ctx.bufhdr, menu_name, menu_type, is_extern=True)
-        emit_cppeol(ctx.bufhdr)
+        ctx.bufsrc.write(STATIC_ITEM_SRC_TEMPLATE.format(
+            minfo_type=minfo_type, minfo_name=minfo_name, progmem=ctx.progmem_suffix,
+            minfo=', '.join(minfo_builtin + minfo_extra),
+            menu_type=menu_type, menu_name=menu_name,
+            menu_item=', '.join(menu_item_first + menu_item_extra + menu_item_last),
+        ))
+        ctx.bufhdr.write(ITEM_HDR_TEMPLATE.format(menu_type=menu_type, menu_name=menu_name))
 
         return menu_name
 
-    def emit_simple_dynamic_menu_item(self, ctx: 'CodeEmitterContext', menu_item_extra: Sequence[Any], name_prefix: Optional[str] = None, cpp_type_prefix: Optional[str] = None, render_callback_parent: Optional[str] = None, global_index_order: bool = 'after_callback', next_entry_namespace: Sequence["MenuBaseType"] = None, custom_callback_ref: Optional[str] = None):
+    def emit_simple_dynamic_menu_item(self, ctx: 'CodeEmitterContext', menu_item_extra: Tuple[str, ...], name_prefix: Optional[str] = None, cpp_type_prefix: Optional[str] = None, render_callback_parent: Optional[str] = None, global_index_order: bool = 'after_callback', custom_callback_ref: Optional[str] = None):
         # global_index_order: first, after_callback, na
-        eeprom_offset = self.find_or_allocate_eeprom_space(ctx.eeprom_map)
-
-        id_ = self.generate_id()
-        ns_id = ''.join(ns.generate_id() for ns in ctx.namespace)
-        if next_entry_namespace is None:
-            next_ns_id = ns_id
+        ns_id = self.get_ns_id()
+        if name_prefix is None:
+            menu_name = self.get_menu_name()
         else:
-            next_ns_id = ''.join(ns.generate_id() for ns in next_entry_namespace)
+            menu_name = f'menu{name_prefix}{ns_id}{self.generate_id()}'
 
-        menu_name = f'menu{name_prefix or ""}{ns_id}{id_}'
+        eeprom_offset = self.find_or_allocate_eeprom_space(ctx.eeprom_map)
         if custom_callback_ref is None:
-            render_callback_name = f'fn{ns_id}{id_}RtCall'
+            render_callback_name = f'fn{ns_id}{self.generate_id()}RtCall'
         else:
             render_callback_name = custom_callback_ref
 
@@ -255,13 +310,12 @@ class MenuBaseType:
 
         menu_type = f'{cpp_type_prefix}MenuItem'
 
-        next_name = f'menu{next_ns_id}{ctx.next_entry.generate_id()}' if ctx.next_entry is not None else None
-        next_name_ref = f'&{next_name}' if next_name is not None else 'nullptr'
+        next_name_ref = f'&{ctx.next_entry.get_menu_name()}' if ctx.next_entry is not None else 'nullptr'
 
         if global_index_order == 'after_callback':
-            menu_item_first = (render_callback_name, self._global_index, )
+            menu_item_first = (render_callback_name, str(self._global_index), )
         elif global_index_order == 'first':
-            menu_item_first = (self._global_index, render_callback_name, )
+            menu_item_first = (str(self._global_index), render_callback_name, )
         elif global_index_order == 'na':
             menu_item_first = (render_callback_name, )
         else:
@@ -270,19 +324,16 @@ class MenuBaseType:
         menu_item_last = (next_name_ref, )
 
         if custom_callback_ref is None:
-            callback_factory_params = ', '.join(map(str, (
-                render_callback_name, render_callback_parent,
-                cppstr(self.name), hex(eeprom_offset), self.get_callback_ref()
-            )))
-            ctx.bufsrc.write(f'RENDERING_CALLBACK_NAME_INVOKE({callback_factory_params})\n')
-
-        emit_cppdef(ctx.bufsrc, menu_name, menu_type)
-        ctx.bufsrc.write(f'({", ".join(map(str, itertools.chain(menu_item_first, menu_item_extra, menu_item_last)))})')
-        emit_cppeol(ctx.bufsrc)
-        ctx.bufsrc.write('\n')
-
-        emit_cppdef(ctx.bufhdr, menu_name, menu_type, is_extern=True)
-        emit_cppeol(ctx.bufhdr)
+            ctx.bufsrc.write(RENDER_CALLBACK_SRC_TEMPLATE.format(
+                callback_name=render_callback_name, callback_parent=render_callback_parent,
+                name=cppstr(self.name), eeprom_offset=hex(eeprom_offset), callback_ref=self.get_callback_ref(),
+            ))
+
+        ctx.bufsrc.write(DYNAMIC_ITEM_SRC_TEMPLATE.format(
+            menu_type=menu_type, menu_name=menu_name,
+            menu_item=', '.join(menu_item_first + menu_item_extra + menu_item_last),
+        ))
+        ctx.bufhdr.write(ITEM_HDR_TEMPLATE.format(menu_type=menu_type, menu_name=menu_name))
 
         return menu_name
 
@@ -290,43 +341,58 @@ class MenuBaseType:
         return 'NO_CALLBACK' if self.callback is None or len(self.callback) == 0 else f'{self.callback}'
 
     def generate_id(self):
-        if self.id_ is not None:
-            id_ = self.id_
-        else:
-            id_ = ''.join(w.capitalize() for w in RE_AUTOID_DELIM.split(self.name))
-        #id_ = f'{id_}{self.get_type_name()}{self.id_suffix if self.id_suffix is not None else ""}'
-        id_ = f'{id_}{self.id_suffix if self.id_suffix is not None else ""}'
-        return id_
+        return self._id
+
+    def assign_namespace(self, ns_id: str):
+        self._ns_id = ns_id
+        self._menu_name = f'menu{ns_id}{self.generate_id()}'
+        self._minfo_name = f'minfo{ns_id}{self.generate_id()}'
+
+    def get_ns_id(self):
+        if self._ns_id is None:
+            raise RuntimeError(f'Namespace of menu item {self.name} is not resolved. Run assign_menu_namespaces() on the menu tree first.')
+        return self._ns_id
+
+    def get_menu_name(self):
+        if self._menu_name is None:
+            raise RuntimeError(f'Namespace of menu item {self.name} is not resolved. Run assign_menu_namespaces() on the menu tree first.')
+        return self._menu_name
 
     def find_or_allocate_eeprom_space(self, eeprom_map: EEPROMMap):
+        if not self.persistent:
+            return 0xffff
         id_ = self.generate_id()
-        if self.__class__.serializable and self.persistent and id_ in eeprom_map:
-            offsize = eeprom_map[id_]
-            if offsize['size'] == self.get_serialized_size():
-                return offsize['offset']
-            else:
+        size = self.get_serialized_size()
+        if self.__class__.serializable:
+            allocated_size = eeprom_map.get_size(id_)
+            if allocated_size == size:
+                return eeprom_map.get_offset(id_)
+            elif allocated_size is not None:
                 # TODO maybe give a warning about this?
                 del eeprom_map[id_]
-                new_offsize = eeprom_map.auto_allocate(id_, self.get_serialized_size())
-                return new_offsize['offset']
-        elif self.persistent:
-            offsize = eeprom_map.auto_allocate(id_, self.get_serialized_size())
-            return offsize['offset']
-        else:
-            return 0xffff
-
-    def list_callbacks(self):
-        return {('on_change', self.callback)} if self.callback is not None else set()
+        return eeprom_map.auto_allocate(id_, size)
+
+    def list_callbacks(self, callback_list: Optional[Set[Tuple[str, str]]] = None):
+        # Callbacks are collected into callback_list when given instead of allocating a set per item
+        if callback_list is None:
+            callback_list = set()
+        if self.callback is not None:
+            callback_list.add(('on_change', self.callback))
+        return callback_list
 
 
 class CodeEmitterContext:
-    def __init__(self, bufsrc: IO[str], bufhdr: IO[str], eeprom_map: EEPROMMap, namespace: Sequence[MenuBaseType], next_entry: MenuBaseType, use_pgmspace: bool):
+    __slots__ = ('bufsrc', 'bufhdr', 'eeprom_map', 'next_entry', 'use_pgmspace', 'progmem_decl', 'progmem_suffix')
+
+    def __init__(self, bufsrc: StringBuffer, bufhdr: StringBuffer, eeprom_map: EEPROMMap, next_entry: MenuBaseType, use_pgmspace: bool):
         self.bufsrc = bufsrc
         self.bufhdr = bufhdr
         self.eeprom_map = eeprom_map
-        self.namespace = namespace
         self.next_entry = next_entry
         self.use_pgmspace = use_pgmspace
+        # PROGMEM qualifier as emit_cppdef extra_decl and as a declarator suffix for the templates
+        self.progmem_decl = ('PROGMEM', ) if use_pgmspace else ()
+        self.progmem_suffix = ' PROGMEM' if use_pgmspace else ''
 
 
 class AnalogType(MenuBaseType):
@@ -334,13 +400,12 @@ class AnalogType(MenuBaseType):
     cpp_type_prefix = 'Analog'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        max_ = v('max', default=None)
-        min_ = v('min', default=None)
-        self.precision = v('precision', default=None)
-        self.offset = v('offset', default=None)
-        self.divisor = v('divisor', default=1)
-        self.unit = v('unit')
+        max_ = validate_entry(props, 'max', default=None)
+        min_ = validate_entry(props, 'min', default=None)
+        self.precision = validate_entry(props, 'precision', default=None)
+        self.offset = validate_entry(props, 'offset', default=None)
+        self.divisor = validate_entry(props, 'divisor', default=1)
+        self.unit = validate_entry(props, 'unit')
         if self.offset is None and min_ is None:
             self.offset = 0
         elif self.offset is None:
@@ -363,10 +428,10 @@ class AnalogType(MenuBaseType):
 
     def emit_code(self, ctx: CodeEmitterContext):
         self.emit_simple_static_menu_item(ctx, (
-            self.precision, self.get_callback_ref(), self.offset, self.divisor,
+            str(self.precision), self.get_callback_ref(), str(self.offset), str(self.divisor),
             cppstr(self.unit) if self.unit is not None else cppstr(""),
         ), (
-            0,
+            '0',
         ))
 
 class LargeNumberType(MenuBaseType):
@@ -375,10 +440,9 @@ class LargeNumberType(MenuBaseType):
     render_callback_parent = 'largeNumItemRenderFn'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        self.decimal_places = v('decimal-places', default=0)
-        self.length = v('length', default=12)
-        self.signed = v('signed', default=False)
+        self.decimal_places = validate_entry(props, 'decimal-places', default=0)
+        self.length = validate_entry(props, 'length', default=12)
+        self.signed = validate_entry(props, 'signed', default=False)
 
     def get_serialized_size(self):
         # TODO is this 7 or 8?
@@ -391,7 +455,7 @@ class LargeNumberType(MenuBaseType):
 
     def emit_code(self, ctx: CodeEmitterContext):
         self.emit_simple_dynamic_menu_item(ctx, (
-            self.length, self.decimal_places, str(self.signed).lower(),
+            str(self.length), str(self.decimal_places), str(self.signed).lower(),
         ), global_index_order='after_callback')
 
 
@@ -399,8 +463,7 @@ class FloatType(MenuBaseType):
     cpp_type_prefix = 'Float'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        self.decimal_places = v('decimal-places', default=2)
+        self.decimal_places = validate_entry(props, 'decimal-places', default=2)
 
     def get_serialized_size(self):
         raise ValueError('FloatType is not serializable')
@@ -410,7 +473,7 @@ class FloatType(MenuBaseType):
 
     def emit_code(self, ctx: CodeEmitterContext):
         self.emit_simple_static_menu_item(ctx, (
-            self.decimal_places, self.get_callback_ref()
+            str(self.decimal_places), self.get_callback_ref()
         ), tuple())
 
 class EnumType(MenuBaseType):
@@ -418,8 +481,7 @@ class EnumType(MenuBaseType):
     cpp_type_prefix = 'Enum'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        self.options = v('options', required=True)
+        self.options = validate_entry(props, 'options', required=True)
 
     def get_serialized_size(self):
         return 2
@@ -428,25 +490,22 @@ class EnumType(MenuBaseType):
         return 'E'
 
     def emit_code(self, ctx: CodeEmitterContext):
-        ns_id = ''.join(ns.generate_id() for ns in ctx.namespace)
-        enum_str_name = f'enumStr{ns_id}{self.generate_id()}'
-
-        # Write enum item strings
-        for i, str_ in enumerate(self.options):
-            emit_cppdef(ctx.bufsrc, f'{enum_str_name}_{i}', 'char', is_const=True, is_static=True, nmemb=0, init=True, extra_decl=('PROGMEM', ) if ctx.use_pgmspace else tuple())
-            ctx.bufsrc.write(cppstr(str_))
-            emit_cppeol(ctx.bufsrc)
+        enum_str_name = f'enumStr{self.get_ns_id()}{self.generate_id()}'
 
+        progmem = ctx.progmem_suffix
         nmemb = len(self.options)
-        emit_cppdef(ctx.bufsrc, enum_str_name, 'char * const', is_const=True, is_static=True, nmemb=nmemb, init=True, extra_decl=('PROGMEM', ) if ctx.use_pgmspace else tuple())
-        with emit_cppobjarray(ctx.bufsrc, multiline=True):
-            ctx.bufsrc.write(',\n'.join(f'    {enum_str_name}_{i}' for i in range(nmemb)))
-        emit_cppeol(ctx.bufsrc)
+
+        # Write enum item strings and the string table in one go
+        lines = [f'static const char {enum_str_name}_{i}[]{progmem} = {cppstr(str_)};' for i, str_ in enumerate(self.options)]
+        lines.append(f'static const char * const {enum_str_name}[{nmemb}]{progmem} = {{')
+        lines.append(',\n'.join([f'    {enum_str_name}_{i}' for i in range(nmemb)]))
+        lines.append('};\n')
+        ctx.bufsrc.write('\n'.join(lines))
 
         # ew
         self.emit_simple_static_menu_item(ctx, (
-            nmemb - 1, self.get_callback_ref(), enum_str_name,
-        ) ,(0, ))
+            str(nmemb - 1), self.get_callback_ref(), enum_str_name,
+        ) ,('0', ))
 
 class ScrollChoiceType(MenuBaseType):
     serializable = True
@@ -454,10 +513,9 @@ class ScrollChoiceType(MenuBaseType):
     render_callback_parent = 'enumItemRenderFn'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        self.item_size = v('item-size', required=True)
-        self.items = v('items', required=True)
-        self.data_source = v('data-source', required=True, extra_validation=self._validate_data_source)
+        self.item_size = validate_entry(props, 'item-size', required=True)
+        self.items = validate_entry(props, 'items', required=True)
+        self.data_source = validate_entry(props, 'data-source', required=True, extra_validation=self._validate_data_source)
         self._mode, self._address = self.data_source.split(':')
 
     def get_serialized_size(self):
@@ -480,31 +538,30 @@ class ScrollChoiceType(MenuBaseType):
     def emit_code(self, ctx: CodeEmitterContext):
         if self._mode in ('eeprom', 'array-in-eeprom'):
             custom_callback = None
-            menu_item_extra = (0, ctx.eeprom_map.spare_segments[self._address], self.item_size, self.items)
+            menu_item_extra = ('0', str(ctx.eeprom_map.spare_segments[self._address]), str(self.item_size), str(self.items))
         elif self._mode in ('ram', 'array-in-ram'):
             custom_callback = None
-            menu_item_extra = (0, self._address, self.item_size, self.items)
+            menu_item_extra = ('0', self._address, str(self.item_size), str(self.items))
             emit_cppdef(ctx.bufsrc, self._address, 'char *', is_const=True, is_extern=True)
             emit_cppeol(ctx.bufsrc)
         else:
             custom_callback = self._address
-            menu_item_extra = (0, self.items)
+            menu_item_extra = ('0', str(self.items))
         self.emit_simple_dynamic_menu_item(ctx,
                                            menu_item_extra, global_index_order='first',
                                            custom_callback_ref=custom_callback)
 
-    def list_callbacks(self):
-        result = super().list_callbacks()
+    def list_callbacks(self, callback_list: Optional[Set[Tuple[str, str]]] = None):
+        callback_list = super().list_callbacks(callback_list)
         if self._mode == 'custom-renderfn':
-            result.add(('on_render', self._address))
-        return result
+            callback_list.add(('on_render', self._address))
+        return callback_list
 
 class BooleanType(MenuBaseType):
     serializable = True
     cpp_type_prefix = 'Boolean'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
 
         _default = {
             'boolean': 'true-false',
@@ -514,7 +571,7 @@ class BooleanType(MenuBaseType):
             'onoff': 'on-off',
             'yesno': 'yes-no'
         }
-        self.response = v('response', default=_default[alias], extra_validation=self._validate_response)
+        self.response = validate_entry(props, 'response', default=_default[alias], extra_validation=self._validate_response)
 
     def get_serialized_size(self):
         return 1
@@ -529,7 +586,7 @@ class BooleanType(MenuBaseType):
             'yes-no': 'NAMING_YES_NO',
         }
         self.emit_simple_static_menu_item(ctx, (
-            1, self.get_callback_ref(), _response_syms[self.response],
+            '1', self.get_callback_ref(), _response_syms[self.response],
         ) ,('false', ))
 
     @staticmethod
@@ -543,9 +600,8 @@ class SubMenuType(MenuBaseType):
     cpp_type_prefix = 'Sub'
     def __init__(self, props, alias):
         super().__init__(props, alias)
-        v = functools.partial(self._validate_entry, props)
-        self.items = tuple(map(parse_tcdesc_yaml_object, v('items', required=True)))
-        self.auth = v('auth', default=False)
+        self.items = tuple(map(parse_tcdesc_yaml_object, validate_entry(props, 'items', required=True)))
+        self.auth = validate_entry(props, 'auth', default=False)
 
     def get_serialized_size(self):
         raise ValueError('SubMenuType is not serializable')
@@ -554,14 +610,14 @@ class SubMenuType(MenuBaseType):
         return f'M'
 
     def emit_code(self, ctx: CodeEmitterContext):
-        # TODO
-        subctx = copy.copy(ctx)
-        subctx.namespace = ctx.namespace + (self, )
-        for i, subitem in enumerate(self.items):
-            subctx.next_entry = self.items[i+1] if len(self.items) > i+1 else None
-            subitem.emit_code(subctx)
-        backctx = copy.copy(ctx)
-        backctx.next_entry = self.items[0]
+        raise RuntimeError('SubMenuType is emitted by emit_menu_items()')
+
+    def create_subcontext(self, ctx: CodeEmitterContext):
+        return CodeEmitterContext(ctx.bufsrc, ctx.bufhdr, ctx.eeprom_map, None, ctx.use_pgmspace)
+
+    def emit_menu_entry(self, ctx: CodeEmitterContext):
+        # Emits the back item and the submenu item itself. Must be called after all children are emitted.
+        backctx = CodeEmitterContext(ctx.bufsrc, ctx.bufhdr, ctx.eeprom_map, self.items[0], ctx.use_pgmspace)
         back_name = self.emit_simple_dynamic_menu_item(
             backctx,
             tuple(),
@@ -570,16 +626,15 @@ class SubMenuType(MenuBaseType):
             cpp_type_prefix='Back',
             render_callback_parent='backSubItemRenderFn',
             global_index_order='na',
-            next_entry_namespace=subctx.namespace,
         )
         self.emit_simple_static_menu_item(ctx, (
-            0, self.get_callback_ref(),
+            '0', self.get_callback_ref(),
         ), (f'&{back_name}', ))
 
-    def list_callbacks(self):
-        callback_list = super().list_callbacks()
+    def list_callbacks(self, callback_list: Optional[Set[Tuple[str, str]]] = None):
+        callback_list = super().list_callbacks(callback_list)
         for item in self.items:
-            callback_list.update(item.list_callbacks())
+            item.list_callbacks(callback_list)
         return callback_list
 
 
@@ -591,9 +646,37 @@ class ActionType(MenuBaseType):
     def emit_code(self, ctx: CodeEmitterContext):
         # seriously having a codegen is not an excuse for inconsistent API design
         self.emit_simple_static_menu_item(ctx, (
-            0, self.get_callback_ref(),
+            '0', self.get_callback_ref(),
         ), tuple(), cpp_type_prefix_minfo='Any')
 
+# Resolve the C++ names of items and everything nested in them. Must run before code generation.
+def assign_menu_namespaces(items: Sequence[MenuBaseType], ns_id: str = ''):
+    stack = [(items, ns_id)]
+    while stack:
+        items, ns_id = stack.pop()
+        for item in items:
+            item.assign_namespace(ns_id)
+            if isinstance(item, SubMenuType):
+                stack.append((item.items, ns_id + item.generate_id()))
+
+# Emit sibling items and everything nested in them, children before the submenu that references them
+def emit_menu_items(ctx: CodeEmitterContext, items: Sequence[MenuBaseType]):
+    # Frame: (context for items, items, remaining item indices, owning submenu, context of the owning submenu)
+    stack = [(ctx, items, iter(range(len(items))), None, None)]
+    while stack:
+        item_ctx, items, indices, submenu, parent_ctx = stack[-1]
+        for i in indices:
+            item = items[i]
+            item_ctx.next_entry = items[i+1] if len(items) > i+1 else None
+            if isinstance(item, SubMenuType):
+                stack.append((item.create_subcontext(item_ctx), item.items, iter(range(len(item.items))), item, item_ctx))
+                break
+            item.emit_code(item_ctx)
+        else:
+            stack.pop()
+            if submenu is not None:
+                submenu.emit_menu_entry(parent_ctx)
+
 YAML_TAG_SUFFIXES: Mapping[str, MenuBaseType] = {
     'analog': AnalogType,
     'fixed': AnalogType,
@@ -641,20 +724,19 @@ YAML_TAG_SUFFIXES: Mapping[str, MenuBaseType] = {
 }
 
 #def tcdesc_multi_constructor(loader: yaml.Loader, tag_suffix, node):
-#    if tag_suffix in YAML_TAG_SUFFIXES:
-#        node_parsed = loader.construct_mapping(node)
-#    else:
+#    constructor = YAML_TAG_SUFFIXES.get(tag_suffix)
+#    if constructor is None:
 #        raise RuntimeError(f'Unknown TCMenu menu entry type {tag_suffix}')
-#    return YAML_TAG_SUFFIXES[tag_suffix](node_parsed, alias=tag_suffix)
+#    return constructor(loader.construct_mapping(node), alias=tag_suffix)
 
 #yaml.add_multi_constructor('!tcm/', tcdesc_multi_constructor, Loader=Loader)
 
 def parse_tcdesc_yaml_object(obj: Mapping):
-    if obj['type'] in YAML_TAG_SUFFIXES:
-        constructor = YAML_TAG_SUFFIXES[obj['type']]
-        return constructor(obj, obj['type'])
-    else:
-        raise RuntimeError(f'Unknown TCMenu menu entry type {obj["type"]}')
+    type_ = obj['type']
+    constructor = YAML_TAG_SUFFIXES.get(type_)
+    if constructor is None:
+        raise RuntimeError(f'Unknown TCMenu menu entry type {type_}')
+    return constructor(obj, type_)
 
 # TODO change paths to path-like?
 def do_codegen(desc_path: str, out_dir: str, source_dir: str, include_dir: str, instance_name: str, eeprom_map: EEPROMMap, use_pgmspace: bool):
@@ -683,95 +765,106 @@ def do_codegen(desc_path: str, out_dir: str, source_dir: str, include_dir: str,
 
     jsonschema.validate(desc, desc_schema)
 
-    bufsrc = io.StringIO()
-    bufhdr = io.StringIO()
+    bufsrc = StringBuffer()
+    bufhdr = StringBuffer()
 
-    namespace = tuple()
     callback_list = set()
 
-    with open(menu_source_path, 'w') as bufsrc, open(menu_header_path, 'w') as bufhdr:
-        # Output header
-        bufsrc.write(SRC_HEADER)
-        bufhdr.write(SRC_HEADER)
-        bufsrc.write('\n')
-        bufhdr.write('\n')
-
-        # Output includes
-        if use_pgmspace:
-            bufsrc.write('#include <Arduino.h>\n')
-        bufsrc.write('#include <tcMenu.h>\n')
-        bufsrc.write(f'#include "{menu_header_name}"\n\n')
-
-        bufhdr.write('#pragma once\n')
-        bufhdr.write('#include <tcMenu.h>\n\n')
-        bufhdr.write(f'#include "{callback_header_name}"\n')
-        bufhdr.write(f'#include "{extra_header_name}"\n\n')
-
-        # Output application info
-        emit_cppdef(bufsrc, 'applicationInfo', 'ConnectorLocalInfo', is_const=True, extra_decl=('PROGMEM', ) if use_pgmspace else tuple(), init=True)
-        with emit_cppobjarray(bufsrc):
-            bufsrc.write(f'{cppstr(desc["name"])}, {cppstr(desc["uuid"])}')
-        emit_cppeol(bufsrc)
-        bufsrc.write('\n')
-
-        emit_cppdef(bufhdr, 'applicationInfo', 'ConnectorLocalInfo', is_const=True, is_extern=True)
-        emit_cppeol(bufhdr)
-
-        ctx = CodeEmitterContext(bufsrc, bufhdr, eeprom_map, namespace, None, use_pgmspace)
-        parsed_items = tuple(map(parse_tcdesc_yaml_object, desc['items']))
-
-        # Output menu descriptor
-        for i, item in enumerate(parsed_items):
-            ctx.next_entry = parsed_items[i+1] if len(parsed_items) > i+1 else None
-            item.emit_code(ctx)
-            callback_list.update(item.list_callbacks())
-
-        # Define a getter for the root of menu descriptor
-        bufhdr.write(f'constexpr MenuItem *getRootMenuItem() {{ return &menu{parsed_items[0].generate_id()}; }}\n')
-
-        bufhdr.write('\n')
-
-        # Define menu property initializer
-        emit_cppdef(bufsrc, 'setupMenuDefaults', 'void')
-        bufsrc.write('() ')
-        with emit_cppobjarray(bufsrc, multiline=True):
-            for item in parsed_items:
-                item.emit_default_flags_block(bufsrc, namespace)
-
-        emit_cppdef(bufhdr, 'setupMenuDefaults', 'void')
-        bufhdr.write('()')
-        emit_cppeol(bufhdr)
+    # Output header
+    bufsrc.write(SRC_HEADER)
+    bufhdr.write(SRC_HEADER)
+    bufsrc.write('\n')
+    bufhdr.write('\n')
+
+    # Output includes
+    if use_pgmspace:
+        bufsrc.write('#include <Arduino.h>\n')
+    bufsrc.write('#include <tcMenu.h>\n')
+    bufsrc.write(f'#include "{menu_header_name}"\n\n')
+
+    bufhdr.write('#pragma once\n')
+    bufhdr.write('#include <tcMenu.h>\n\n')
+    bufhdr.write(f'#include "{callback_header_name}"\n')
+    bufhdr.write(f'#include "{extra_header_name}"\n\n')
+
+    ctx = CodeEmitterContext(bufsrc, bufhdr, eeprom_map, None, use_pgmspace)
+
+    # Output application info
+    emit_cppdef(bufsrc, 'applicationInfo', 'ConnectorLocalInfo', is_const=True, extra_decl=ctx.progmem_decl, init=True)
+    emit_cppobjarray_begin(bufsrc)
+    bufsrc.write(f'{cppstr(desc["name"])}, {cppstr(desc["uuid"])}')
+    emit_cppobjarray_end(bufsrc)
+    emit_cppeol(bufsrc)
+    bufsrc.write('\n')
+
+    emit_cppdef(bufhdr, 'applicationInfo', 'ConnectorLocalInfo', is_const=True, is_extern=True)
+    emit_cppeol(bufhdr)
+
+    parsed_items = tuple(map(parse_tcdesc_yaml_object, desc['items']))
+    assign_menu_namespaces(parsed_items)
+
+    # Output menu descriptor
+    emit_menu_items(ctx, parsed_items)
+    for item in parsed_items:
+        item.list_callbacks(callback_list)
+
+    # Define a getter for the root of menu descriptor
+    bufhdr.write(f'constexpr MenuItem *getRootMenuItem() {{ return &{parsed_items[0].get_menu_name()}; }}\n')
+
+    bufhdr.write('\n')
+
+    # Define menu property initializer
+    emit_cppdef(bufsrc, 'setupMenuDefaults', 'void')
+    bufsrc.write('() ')
+    emit_cppobjarray_begin(bufsrc, multiline=True)
+    for item in parsed_items:
+        item.emit_default_flags_block(bufsrc)
+    emit_cppobjarray_end(bufsrc, multiline=True)
+
+    emit_cppdef(bufhdr, 'setupMenuDefaults', 'void')
+    bufhdr.write('()')
+    emit_cppeol(bufhdr)
 
     # Generate callback header
-    with open(callback_header_path, 'w') as bufcb:
-        bufcb.write(SRC_HEADER)
-        bufcb.write('\n')
-
-        bufcb.write('#pragma once\n')
-        bufcb.write('#include <tcMenu.h>\n')
-        bufcb.write('#include <stdint.h>\n\n')
-
-        callback_overlap_check = {}
-        for cb_type, cb_ref in callback_list:
-            if cb_ref in callback_overlap_check:
-                raise RuntimeError(f'Callback {cb_ref} conflicts with other callbacks.')
-            callback_overlap_check[cb_ref] = cb_type
-            if cb_type == 'on_change':
-                bufcb.write(f'void {cb_ref}(int id);\n')
-            elif cb_type == 'on_render':
-                bufcb.write(f'int {cb_ref}(RuntimeMenuItem* item, uint8_t row, RenderFnMode mode, char* buffer, int bufferSize);\n')
-
-    with open(extra_header_path, 'w') as bufext:
-        # TODO: Make this dynamic?
-        bufext.write(SRC_HEADER)
-        bufext.write('\n')
-
-        bufext.write('#pragma once\n')
-        bufext.write('#include <ScrollChoiceMenuItem.h>\n')
-        bufext.write('#include <EditableLargeNumberMenuItem.h>\n')
+    bufcb = StringBuffer()
+    bufcb.write(SRC_HEADER)
+    bufcb.write('\n')
+
+    bufcb.write('#pragma once\n')
+    bufcb.write('#include <tcMenu.h>\n')
+    bufcb.write('#include <stdint.h>\n\n')
+
+    callback_overlap_check = {}
+    for cb_type, cb_ref in callback_list:
+        if cb_ref in callback_overlap_check:
+            raise RuntimeError(f'Callback {cb_ref} conflicts with other callbacks.')
+        callback_overlap_check[cb_ref] = cb_type
+        if cb_type == 'on_change':
+            bufcb.write(f'void {cb_ref}(int id);\n')
+        elif cb_type == 'on_render':
+            bufcb.write(f'int {cb_ref}(RuntimeMenuItem* item, uint8_t row, RenderFnMode mode, char* buffer, int bufferSize);\n')
+
+    # TODO: Make this dynamic?
+    bufext = StringBuffer()
+    bufext.write(SRC_HEADER)
+    bufext.write('\n')
+
+    bufext.write('#pragma once\n')
+    bufext.write('#include <ScrollChoiceMenuItem.h>\n')
+    bufext.write('#include <EditableLargeNumberMenuItem.h>\n')
+
+    # Everything is rendered in memory, so each file is written with a single
+    # write() and nothing is touched if generation fails halfway.
+    for path, buf in ((menu_source_path, bufsrc), (menu_header_path, bufhdr), (callback_header_path, bufcb), (extra_header_path, bufext)):
+        with open(path, 'w') as f:
+            f.write(buf.getvalue())
 
 if __name__ == '__main__':
     p, args = parse_args()
+    if not HAS_LIBYAML:
+        if os.environ.get(REQUIRE_LIBYAML_ENV, '') not in ('', '0'):
+            p.error(f'PyYAML is not built with libyaml support but {REQUIRE_LIBYAML_ENV} is set.')
+        print('WARNING: PyYAML is not built with libyaml support. Falling back to the (much slower) pure-Python YAML loader.')
     desc_dirname, desc_basename = os.path.split(args.desc)
 
     is_standard_suffix = len(desc_basename) > len(DESC_SUFFIX) and desc_basename.endswith(DESC_SUFFIX)